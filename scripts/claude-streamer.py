@@ -8,6 +8,14 @@ Usage:
     The Slack token MUST be passed via the SLACK_TOKEN environment variable (not as argument)
     to prevent token exposure in process listings.
 
+    With CLAUDE_MESSAGE_STDIN=1, omit both base64 arguments: the message is read as raw UTF-8
+    from stdin and the optional files JSON from file descriptor 3. This skips the base64
+    round-trip and avoids argv length limits for long messages.
+
+    With CLAUDE_FILE_CACHE=1, downloaded attachments are also kept (owner-only) under
+    ~/.cache/claude-streamer/files for up to 24h, so a file referenced again in the thread is
+    not fetched again. Off by default: it leaves private Slack files on disk.
+
 Features:
     - Real-time progress updates (Editing file..., Creating file..., Running command...)
     - Silently counts read operations (no spam)
@@ -21,38 +29,142 @@ import sys
 import json
 import subprocess
 import requests
+import urllib3
 import base64
 import os
 import tempfile
 import shutil
 import stat
+import signal
+import fcntl
+import hashlib
+import select
 import logging
 import time
 import re
+import random
 import threading
+import queue
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from logging.handlers import RotatingFileHandler
 from datetime import datetime
 
-# Supported file types
-IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.webp'}
-PDF_EXTENSIONS = {'.pdf'}
+try:
+    import orjson  # Optional: much faster stream-json parsing and Slack payload encoding
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+try:
+    import httpx  # Optional: HTTP/2 for chat.postMessage/chat.update (pip install "httpx[http2]")
+    import h2  # noqa: F401 - httpx needs it for http2=True
+except ImportError:
+    httpx = None
+
+# Supported file types (lowercase extensions, without the dot)
+IMAGE_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg', 'gif', 'webp'})
+PDF_EXTENSIONS = frozenset({'pdf'})
 SUPPORTED_EXTENSIONS = IMAGE_EXTENSIONS | PDF_EXTENSIONS
 
 # File limits (security: prevent resource exhaustion)
 MAX_FILE_SIZE_MB = 10  # Maximum file size in MB
 MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
 MAX_FILE_COUNT = 5  # Maximum number of files per message
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # Read attachments in 1MB chunks to amortize per-chunk overhead
+# RAM-based (tmpfs) parent directories for downloaded files, in order of preference.
+# The user runtime directory is private to the user; mkdtemp makes our subdirectory 0700 either way.
+SCRATCH_DIR_CANDIDATES = ("/run/user/{uid}", "/dev/shm")
 
 # Streaming text configuration
 STREAM_UPDATE_INTERVAL_MS = 500  # Minimum time between Slack updates (rate limit protection)
 STREAM_MIN_CHARS = 50  # Minimum new characters before updating
+STREAM_BURST_MAX = 3  # Maximum non-final updates allowed within the burst window
+STREAM_BURST_WINDOW_MS = 3000  # Burst window; pending text is coalesced into the next allowed update
 STREAM_TYPING_INDICATOR = "..."  # Simple ellipsis while streaming
+STREAM_TYPING_INDICATOR_LENGTH = len(STREAM_TYPING_INDICATOR)
 SLACK_MAX_MESSAGE_LENGTH = 39000  # Slack's limit is 40000, leave buffer for safety
+STREAM_SAFE_CUTOFF = SLACK_MAX_MESSAGE_LENGTH - 200  # Split point for long messages (room for continuation text)
+STREAM_NEWLINE_SEARCH_WINDOW = 500  # Look this far back from the cutoff for a newline to split on
+STREAM_SPACE_SEARCH_WINDOW = 100  # ...or this far back for a space
+CLAUDE_PIPE_BUFFER_SIZE = 64 * 1024  # Read buffer for Claude's (binary) stdout pipe
+STREAM_QUEUE_MAX_LINES = 128  # Lines read ahead of the parser before the reader thread waits
+STREAM_IDLE_POLL_MIN = 0.25  # Seconds to wait for a line before an idle pass; doubles while Claude is silent
+STREAM_IDLE_POLL_MAX = 2.0  # ...up to this, so a safe word is acted on within one poll interval
+CLAUDE_PIPE_CAPACITY = 1024 * 1024  # Kernel pipe size for Claude's stdout, so bursts don't block its writes
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)  # Linux-only fcntl, not exposed before Python 3.10
+SESSION_PEEK_POLL_INTERVAL = 0.1  # Seconds between stderr checks while waiting for Claude's first line
+FINAL_UPDATE_ATTEMPTS = 3  # The final streaming update is retried this many times
+FINAL_UPDATE_BACKOFF_BASE = 0.1  # Seconds before the first retry, tripled for each one after
+FINAL_UPDATE_BACKOFF_JITTER = 0.05  # Up to this many random seconds added to each delay
+
+# Progress message batching (tool notifications, file downloads)
+PROGRESS_BATCH_MAX_ITEMS = 5  # Flush once this many progress lines are queued
+PROGRESS_BATCH_MAX_INTERVAL = 1.0  # ...or once this many seconds passed since the last flush
+PROGRESS_BATCH_DEBOUNCE = 0.25  # Always wait this long after a line, to gather its neighbours
+
+# File descriptor carrying the files JSON when CLAUDE_MESSAGE_STDIN=1
+FILES_JSON_FD = 3
+# Claimed here, before this module opens any file: if the caller left FD 3 closed, the log
+# handler below would be handed it, and reading (then closing) it would break logging.
+# None when the caller passed nothing there.
+try:
+    inherited_files_fd = os.dup(FILES_JSON_FD) if os.environ.get('CLAUDE_MESSAGE_STDIN') == '1' else None
+except OSError:
+    inherited_files_fd = None
+
+# End-of-session summary: (counter name, Slack wording), in display order
+SUMMARY_SPECS = (
+    ("reads", "read {n} file(s)"),
+    ("edits", "edited {n} file(s)"),
+    ("writes", "created {n} file(s)"),
+    ("commands", "ran {n} command(s)"),
+    ("globs", "searched {n} pattern(s)"),
+    ("greps", "grepped {n} time(s)"),
+    ("web_fetches", "fetched {n} URL(s)"),
+    ("web_searches", "web searched {n} time(s)"),
+    ("tasks", "spawned {n} agent(s)"),
+    ("mcp_calls", "called {n} MCP tool(s)"),
+)
+# Per-file actions for the summary's Modified: line: (action, Slack wording), in display order
+FILE_ACTION_LABELS = (("write", "created"), ("edit", "edited"))
+USAGE_INPUT_TOKEN_KEYS = ("input_tokens", "cache_read_input_tokens", "cache_creation_input_tokens")
 
 # Safe word configuration
 SAFE_WORD = "!stop"
 SAFE_WORD_POLL_INTERVAL = 2  # Check for safe word every 2 seconds
 
+# Precompiled patterns
+MENTION_PATTERN = re.compile(r'<@[A-Z0-9]+>')  # Slack user mentions (e.g., <@U12345678>)
+# Bash commands too routine to announce in Slack (first word, followed by any whitespace or nothing)
+BASH_SKIP_PATTERN = re.compile(r'(?:cat|head|tail|ls|pwd|echo|grep|find|source)(?:\s|$)')
+
+# Prompts wrapping the user's message when files are attached
+FILES_PROMPT_TEMPLATE = """The user has attached the following file(s). Please read and analyze them as part of your response:
+
+{files_text}
+
+User's message: {message}"""
+FILES_ONLY_PROMPT_TEMPLATE = """The user has attached the following file(s). Please read and analyze them:
+
+{files_text}"""
+
+# Session IDs Claude has already created for this user, one per line
+SESSION_CACHE_FILE = os.path.expanduser("~/.cache/claude-streamer/sessions")
+SESSION_CACHE_MAX_BYTES = 256 * 1024  # ~7000 IDs; beyond this only the newest half is kept
+
+# Opt-in (CLAUDE_FILE_CACHE=1) attachment cache, keyed by a hash of URL, name and size, so a
+# file referenced again in the thread is copied from disk instead of fetched from Slack again
+FILE_CACHE_DIR = os.path.expanduser("~/.cache/claude-streamer/files")
+FILE_CACHE_TTL = 24 * 60 * 60  # Seconds; older entries are re-downloaded and pruned
+FILE_CACHE_MAX_BYTES = 200 * 1024 * 1024  # Oldest entries are pruned beyond this total
+
 # Logging configuration
 LOG_DIR = "/var/log/claude-streamer"
 LOG_FILE = os.path.join(LOG_DIR, "claude-streamer.log")
@@ -98,77 +210,208 @@ def log_event(level, message, channel=None, session=None, **extra):
     elif level == "error":
         logger.error(full_message)
 
-def send_slack(token, channel, thread_ts, text):
+# Shared HTTP session: keeps TCP+TLS connections to Slack alive across API calls.
+# It only carries idempotent traffic (file downloads, conversations.replies polling,
+# reactions), so transient errors and 429s are safe to retry here
+slack_session = requests.Session()
+slack_session.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=frozenset({"GET", "POST"}), raise_on_status=False)
+))
+
+# Hot-path chat.postMessage/chat.update calls go straight through urllib3 (which requests
+# wraps), skipping requests' per-call session, adapter and hook machinery
+slack_http = urllib3.PoolManager(num_pools=2, maxsize=8, retries=False)
+slack_json_headers = {"Content-Type": "application/json; charset=utf-8"}
+# When httpx[http2] is installed, those calls share one multiplexed HTTP/2 connection instead
+slack_h2 = httpx.Client(http2=True) if httpx else None
+SLACK_TIMEOUT_ERRORS = (urllib3.exceptions.TimeoutError,) + ((httpx.TimeoutException,) if httpx else ())
+
+# Time (epoch seconds) until which Slack asked us to back off (HTTP 429 Retry-After)
+slack_rate_limited_until = 0
+
+def init_slack_session(token):
+    """Authenticate all Slack API calls made through the shared session and pool."""
+    slack_session.headers["Authorization"] = f"Bearer {token}"
+    slack_json_headers["Authorization"] = f"Bearer {token}"
+
+def note_rate_limit(status, headers):
+    """Record Slack's Retry-After cooldown if the response was rate limited."""
+    global slack_rate_limited_until
+    if status != 429:
+        return
+    try:
+        retry_after = float(headers.get("Retry-After", 1))
+    except ValueError:
+        retry_after = 1
+    slack_rate_limited_until = max(slack_rate_limited_until, time.time() + retry_after)
+    print(f"Slack rate limited, backing off for {retry_after:.0f}s", file=sys.stderr)
+
+def final_update_backoff(attempt):
+    """Seconds to wait after a failed final update attempt (0-based).
+
+    Exponential with jitter (0.1s, 0.3s, ...), stretched to Slack's Retry-After when rate limited.
+    """
+    delay = FINAL_UPDATE_BACKOFF_BASE * (3 ** attempt) + random.uniform(0, FINAL_UPDATE_BACKOFF_JITTER)
+    return max(delay, slack_rate_limited_until - time.time())
+
+def slack_api_post(method, payload, timeout=10):
+    """POST a JSON payload to a Slack Web API method. Returns the decoded response body."""
+    url = f"https://slack.com/api/{method}"
+    body = json_dumps(payload)
+    if slack_h2 is not None:
+        response = slack_h2.post(url, content=body, headers=slack_json_headers, timeout=timeout)
+        note_rate_limit(response.status_code, response.headers)
+        return json_loads(response.content)
+    response = slack_http.request(
+        "POST",
+        url,
+        body=body,
+        headers=slack_json_headers,
+        timeout=urllib3.Timeout(total=timeout)
+    )
+    note_rate_limit(response.status, response.headers)
+    return json_loads(response.data)
+
+def send_slack(channel, thread_ts, text):
     """Send a message to Slack. Returns message timestamp if successful."""
     try:
-        response = requests.post(
-            "https://slack.com/api/chat.postMessage",
-            headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
-            json={"channel": channel, "thread_ts": thread_ts, "text": text},
-            timeout=10
-        )
-        data = response.json()
+        data = slack_api_post("chat.postMessage", {"channel": channel, "thread_ts": thread_ts, "text": text})
         if data.get("ok"):
             return data.get("ts")
     except Exception as e:
         print(f"Error sending to Slack: {e}", file=sys.stderr)
     return None
 
-def update_slack_message(token, channel, ts, text, timeout=10):
+def update_slack_message(channel, ts, text, timeout=10):
     """Update an existing Slack message. Returns True if successful."""
     try:
         # Truncate if too long (Slack limit is 40000 chars)
         if len(text) > SLACK_MAX_MESSAGE_LENGTH:
             text = text[:SLACK_MAX_MESSAGE_LENGTH] + "\n\n_[Message truncated - exceeded Slack's 40KB limit]_"
 
-        response = requests.post(
-            "https://slack.com/api/chat.update",
-            headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
-            json={"channel": channel, "ts": ts, "text": text},
-            timeout=timeout
-        )
-        data = response.json()
+        data = slack_api_post("chat.update", {"channel": channel, "ts": ts, "text": text}, timeout=timeout)
         if not data.get("ok"):
             error = data.get("error", "unknown")
             print(f"Slack update error: {error} (ts={ts}, text_len={len(text)})", file=sys.stderr)
             return False
         return True
-    except requests.exceptions.Timeout:
+    except SLACK_TIMEOUT_ERRORS:
         print(f"Slack update timeout after {timeout}s (ts={ts}, text_len={len(text)})", file=sys.stderr)
         return False
     except Exception as e:
         print(f"Error updating Slack message: {e} (ts={ts}, text_len={len(text)})", file=sys.stderr)
         return False
 
-def add_reaction(token, channel, timestamp, emoji):
+# Reactions are posted in the background so they never delay Claude startup or streaming.
+# Two workers let the final remove/add pair run concurrently; replace_reaction keeps the
+# one ordering that matters (the processing emoji is added before it is removed).
+reaction_pool = ThreadPoolExecutor(max_workers=2)
+
+def add_reaction(channel, timestamp, emoji):
+    """Add a reaction to a message in the background. Returns a Future."""
+    return reaction_pool.submit(_add_reaction, channel, timestamp, emoji)
+
+def replace_reaction(channel, timestamp, old_emoji, new_emoji, after=None):
+    """Swap old_emoji for new_emoji in the background, both calls in flight at once.
+
+    after is the Future that added old_emoji; the removal waits for it so it can't overtake it.
+    """
+    def remove():
+        if after is not None:
+            after.result()
+        _remove_reaction(channel, timestamp, old_emoji)
+
+    return reaction_pool.submit(remove), reaction_pool.submit(_add_reaction, channel, timestamp, new_emoji)
+
+# Non-final streaming updates (chat.update) and progress notices are posted from their own
+# worker so parsing Claude's output never waits on Slack; forced/final updates, new streaming
+# messages and the summary stay synchronous. A single worker keeps these posts in order.
+slack_post_pool = ThreadPoolExecutor(max_workers=1)
+
+def _add_reaction(channel, timestamp, emoji):
     """Add a reaction to a message."""
     try:
-        requests.post(
+        slack_session.post(
             "https://slack.com/api/reactions.add",
-            headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
             json={"channel": channel, "timestamp": timestamp, "name": emoji},
             timeout=10
         )
     except Exception as e:
         print(f"Error adding reaction: {e}", file=sys.stderr)
 
-def remove_reaction(token, channel, timestamp, emoji):
+def _remove_reaction(channel, timestamp, emoji):
     """Remove a reaction from a message."""
     try:
-        requests.post(
+        slack_session.post(
             "https://slack.com/api/reactions.remove",
-            headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
             json={"channel": channel, "timestamp": timestamp, "name": emoji},
             timeout=10
         )
     except Exception as e:
         print(f"Error removing reaction: {e}", file=sys.stderr)
 
+class ProgressBatcher:
+    """Coalesces progress lines into a single chat.postMessage per batch.
+
+    A debounce timer flushes queued lines once max_interval has passed since the last
+    flush, so a notice never waits for Claude's next event (e.g. during a long tool run).
+    """
+
+    def __init__(self, channel, thread_ts, max_items=PROGRESS_BATCH_MAX_ITEMS,
+                 max_interval=PROGRESS_BATCH_MAX_INTERVAL):
+        self.channel = channel
+        self.thread_ts = thread_ts
+        self.max_items = max_items
+        self.max_interval = max_interval
+        self.lines = deque()
+        self.last_flush_ts = 0  # First line after a quiet period only waits for the debounce
+        self._pending = None  # Future of the latest background post
+        self._timer = None  # Armed debounce timer, if any
+        self._lock = threading.Lock()  # add() runs on the main thread, the timer on its own
+
+    def add(self, line):
+        with self._lock:
+            self.lines.append(line)
+            if self._timer is None:
+                delay = max(PROGRESS_BATCH_DEBOUNCE, self.max_interval - (time.time() - self.last_flush_ts))
+                self._timer = threading.Timer(delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def maybe_flush(self):
+        """Flush right away once enough lines are queued (the timer handles the rest)."""
+        if len(self.lines) >= self.max_items:
+            self.flush()
+
+    def flush(self):
+        """Post queued lines in the background (fire-and-forget, in order on slack_post_pool)."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self.lines:
+                self._pending = slack_post_pool.submit(send_slack, self.channel, self.thread_ts,
+                                                       "\n".join(self.lines))
+                self.lines.clear()
+                self.last_flush_ts = time.time()
+
+    def drain(self):
+        """Flush, then wait until every progress post has reached Slack.
+
+        Call before a synchronous post that must appear after the progress notices.
+        """
+        self.flush()
+        pending = self._pending
+        if pending is not None:
+            pending.result()
+
 class SafeWordMonitor:
     """Monitors a Slack thread for the safe word and kills the process if detected."""
 
-    def __init__(self, token, channel, thread_ts, bot_start_ts):
-        self.token = token
+    def __init__(self, channel, thread_ts, bot_start_ts):
         self.channel = channel
         self.thread_ts = thread_ts
         self.bot_start_ts = bot_start_ts  # Only check messages after this timestamp
@@ -202,9 +445,8 @@ class SafeWordMonitor:
     def _check_thread(self):
         """Check thread replies for the safe word."""
         try:
-            response = requests.get(
+            response = slack_session.get(
                 "https://slack.com/api/conversations.replies",
-                headers={"Authorization": f"Bearer {self.token}"},
                 params={
                     "channel": self.channel,
                     "ts": self.thread_ts,
@@ -233,58 +475,333 @@ class SafeWordMonitor:
             print(f"SafeWordMonitor check error: {e}", file=sys.stderr)
 
 
-def get_file_size_from_slack(token, file_url):
-    """Get file size using HEAD request before downloading."""
-    try:
-        response = requests.head(
-            file_url,
-            headers={"Authorization": f"Bearer {token}"},
-            timeout=10,
-            allow_redirects=True
-        )
-        if response.status_code == 200:
-            content_length = response.headers.get('Content-Length')
-            if content_length:
-                return int(content_length)
-    except Exception as e:
-        print(f"Error getting file size: {e}", file=sys.stderr)
-    return None
+class FileSizeLimitExceeded(Exception):
+    """Raised when a download grows past its size limit."""
+
+
+class SizeLimitedWriter:
+    """File wrapper that counts bytes written and enforces a size limit."""
 
-def download_slack_file(token, file_url, dest_path, max_size=MAX_FILE_SIZE_BYTES):
+    def __init__(self, f, max_size):
+        self.f = f
+        self.max_size = max_size
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        # Check before writing so we never write past the limit
+        if self.size > self.max_size:
+            raise FileSizeLimitExceeded(self.size)
+        return self.f.write(data)
+
+def download_slack_file(file_url, dest_path, max_size=MAX_FILE_SIZE_BYTES):
     """Download a file from Slack with size limit."""
     try:
-        # Stream download to check size as we go
-        response = requests.get(
-            file_url,
-            headers={"Authorization": f"Bearer {token}"},
-            timeout=60,
-            stream=True
-        )
-        if response.status_code == 200:
-            # Check Content-Length header if available
-            content_length = response.headers.get('Content-Length')
-            if content_length and int(content_length) > max_size:
-                print(f"File too large: {int(content_length)} bytes (max: {max_size})", file=sys.stderr)
-                return False, "exceeds_size_limit"
-
-            # Download with size check
-            downloaded_size = 0
-            with open(dest_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    downloaded_size += len(chunk)
-                    if downloaded_size > max_size:
-                        print(f"File exceeded size limit during download: {downloaded_size} bytes", file=sys.stderr)
-                        f.close()
-                        os.remove(dest_path)
-                        return False, "exceeds_size_limit"
-                    f.write(chunk)
-            return True, None
-        else:
-            print(f"Failed to download file: HTTP {response.status_code} - URL: {file_url[:100]} - Response: {response.text[:200]}", file=sys.stderr)
+        # Stream download to check size as we go; closing the response on every exit
+        # path (including early size-limit returns) hands the connection back to the pool
+        with slack_session.get(file_url, timeout=60, stream=True) as response:
+            if response.status_code == 200:
+                # Check Content-Length header if available (covers files without a size in
+                # Slack's metadata, at no extra round-trip since the connection is already open)
+                content_length = response.headers.get('Content-Length')
+                if content_length and int(content_length) > max_size:
+                    print(f"File too large: {int(content_length)} bytes (max: {max_size})", file=sys.stderr)
+                    return False, "exceeds_size_limit"
+
+                # Copy straight from the raw socket stream, bypassing iter_content's per-chunk overhead
+                response.raw.decode_content = True
+                try:
+                    with open(dest_path, 'wb') as f:
+                        shutil.copyfileobj(response.raw, SizeLimitedWriter(f, max_size), DOWNLOAD_CHUNK_SIZE)
+                except FileSizeLimitExceeded as e:
+                    print(f"File exceeded size limit during download: {e} bytes", file=sys.stderr)
+                    os.remove(dest_path)
+                    return False, "exceeds_size_limit"
+                return True, None
+            else:
+                # Only read as much of the error body as we print (response.text would buffer all of it)
+                error_body = response.raw.read(200, decode_content=True).decode('utf-8', 'replace')
+                print(f"Failed to download file: HTTP {response.status_code} - URL: {file_url[:100]} - Response: {error_body}", file=sys.stderr)
     except Exception as e:
         print(f"Error downloading file: {e}", file=sys.stderr)
     return False, "download_error"
 
+def unique_file_name(file_name, used_names):
+    """Return file_name, or name-2.ext, name-3.ext... if it is already in used_names (which is updated).
+
+    Slack names every pasted screenshot image.png, and concurrent downloads must not share a path.
+    """
+    candidate = file_name
+    stem, dot, ext = file_name.rpartition('.')
+    if not stem:
+        stem, dot, ext = file_name, '', ''  # No extension, or a dotfile
+    n = 1
+    while candidate in used_names:
+        n += 1
+        candidate = f"{stem}-{n}{dot}{ext}"
+    used_names.add(candidate)
+    return candidate
+
+def file_cache_path(file_url, file_name, file_size):
+    """Return the cache path for an attachment (two-level fan-out keeps directories small)."""
+    key = hashlib.sha256(f"{file_url}\0{file_name}\0{file_size}".encode()).hexdigest()
+    return os.path.join(FILE_CACHE_DIR, key[:2], key)
+
+def cached_download(file_url, file_name, file_size, dest_path):
+    """download_slack_file behind the on-disk file cache. Same return value.
+
+    Entries are copied in both directions rather than linked: the scratch directory may be
+    on tmpfs, and Claude must not be able to modify a cached file through its own copy.
+    """
+    cache_path = file_cache_path(file_url, file_name, file_size)
+    try:
+        if time.time() - os.stat(cache_path).st_mtime < FILE_CACHE_TTL:
+            shutil.copyfile(cache_path, dest_path)
+            return True, None
+    except OSError:
+        pass  # Missing, unreadable or racing a prune: download as usual
+
+    # dest_path is private to this download, so only its own bytes can reach the cache
+    success, error = download_slack_file(file_url, dest_path)
+    if success:
+        tmp_path = None
+        try:
+            bucket = os.path.dirname(cache_path)
+            os.makedirs(FILE_CACHE_DIR, mode=stat.S_IRWXU, exist_ok=True)
+            os.makedirs(bucket, mode=stat.S_IRWXU, exist_ok=True)
+            # Copy under a private (0600) name, then rename, so readers never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=bucket)
+            os.close(fd)
+            shutil.copyfile(dest_path, tmp_path)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"Could not update file cache: {e}", file=sys.stderr)
+            if tmp_path:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+    return success, error
+
+def prune_file_cache():
+    """Remove expired cache entries, then the oldest ones while the total exceeds FILE_CACHE_MAX_BYTES."""
+    cutoff = time.time() - FILE_CACHE_TTL
+    kept = []  # (mtime, size, path) of live entries
+    try:
+        buckets = [entry.path for entry in os.scandir(FILE_CACHE_DIR) if entry.is_dir()]
+    except OSError:
+        return  # No cache yet
+    for bucket in buckets:
+        try:
+            with os.scandir(bucket) as entries:
+                for entry in entries:
+                    try:
+                        st = entry.stat()
+                        if st.st_mtime < cutoff:
+                            os.remove(entry.path)
+                        else:
+                            kept.append((st.st_mtime, st.st_size, entry.path))
+                    except OSError:
+                        pass  # Removed by a concurrent run
+        except OSError:
+            pass
+    total = sum(size for _, size, _ in kept)
+    for _, size, path in sorted(kept):
+        if total <= FILE_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+def read_inherited_fd(fd):
+    """Read a file descriptor we own to EOF, then close it. Returns b"" on a read error."""
+    try:
+        with open(fd, 'rb') as f:
+            return f.read()
+    except OSError:
+        return b""
+
+def get_scratch_base_dir():
+    """Return a writable RAM-based directory for downloaded files, or None for the system default.
+
+    Claude's --add-dir needs a real directory, so files can't live in memfds;
+    a tmpfs-backed directory keeps them in memory instead.
+    """
+    uid = os.getuid()
+    for candidate in SCRATCH_DIR_CANDIDATES:
+        path = candidate.format(uid=uid)
+        if os.path.isdir(path) and os.access(path, os.W_OK | os.X_OK):
+            return path
+    return None
+
+def load_known_sessions():
+    """Return the set of cached session IDs (empty if there is no cache yet)."""
+    try:
+        with open(SESSION_CACHE_FILE) as f:
+            return set(f.read().split())
+    except OSError:
+        return set()
+
+def remember_session(session_id):
+    """Append a session ID to the cache (small O_APPEND writes don't interleave)."""
+    try:
+        os.makedirs(os.path.dirname(SESSION_CACHE_FILE), exist_ok=True)
+        with open(SESSION_CACHE_FILE, 'a') as f:
+            f.write(session_id + "\n")
+            size = f.tell()
+        if size > SESSION_CACHE_MAX_BYTES:
+            compact_session_cache()
+    except OSError as e:
+        print(f"Could not update session cache: {e}", file=sys.stderr)
+
+def compact_session_cache():
+    """Keep the newest half of the session cache, so reading it stays cheap.
+
+    An ID dropped here (or an append racing the rename) only costs the old thread heuristic
+    and, if that guesses wrong, the session-flag fallback.
+    """
+    with open(SESSION_CACHE_FILE) as f:
+        lines = f.readlines()
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(SESSION_CACHE_FILE))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(lines[len(lines) // 2:])
+        os.replace(tmp_path, SESSION_CACHE_FILE)
+    except OSError:
+        os.remove(tmp_path)
+        raise
+
+def start_claude(cmd, error_lines):
+    """Start Claude with stdout (pure stream-json) and stderr on separate pipes.
+
+    A daemon thread drains stderr into error_lines, so error output never goes through
+    the JSON parser and a chatty stderr can't fill its pipe and stall Claude.
+    Returns (process, stderr_thread).
+    """
+    # Own session/process group, so stopping Claude also stops the tools it spawned.
+    # (start_new_session rather than preexec_fn=os.setsid: preexec_fn isn't safe with threads)
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               bufsize=CLAUDE_PIPE_BUFFER_SIZE, start_new_session=True)
+    try:
+        fcntl.fcntl(process.stdout.fileno(), F_SETPIPE_SZ, CLAUDE_PIPE_CAPACITY)
+    except OSError:
+        pass  # Not Linux, or above /proc/sys/fs/pipe-max-size: keep the default 64KB pipe
+    stderr_thread = threading.Thread(target=drain_stderr, args=(process.stderr, error_lines), daemon=True)
+    stderr_thread.start()
+    return process, stderr_thread
+
+def peek_first_line(process, error_lines, session_error, safe_word_monitor):
+    """Read Claude's first stdout line, however long Claude takes to start.
+
+    Returns the line, b"" if Claude exited without output, or None as soon as session_error
+    shows up in error_lines (Claude may print it and keep running until it is killed) or the
+    safe word is triggered (the stream loop then stops Claude before reading anything).
+    """
+    while True:
+        ready, _, _ = select.select([process.stdout], [], [], SESSION_PEEK_POLL_INTERVAL)
+        if ready:
+            return process.stdout.readline()
+        if safe_word_monitor.triggered or any(session_error in line for line in error_lines):
+            return None
+
+def kill_claude(process, sig=signal.SIGKILL):
+    """Signal Claude's whole process group if it is still running."""
+    if process.poll() is None:
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            pass
+
+def reap_claude(process, timeout=5):
+    """Make sure Claude and its process group are gone: SIGTERM, then SIGKILL after timeout."""
+    kill_claude(process, signal.SIGTERM)
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_claude(process)
+        process.wait()
+
+def exit_on_signal(signum, frame):
+    """SIGTERM/SIGHUP handler: raise SystemExit so main()'s finally reaps Claude.
+
+    Claude runs in its own session, so these signals no longer reach it directly. Further
+    signals are ignored so they can't interrupt that cleanup.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    raise SystemExit(128 + signum)
+
+def drain_stderr(pipe, error_lines):
+    """Collect non-empty stderr lines until the pipe closes."""
+    for line in pipe:
+        line = line.strip()
+        if line:
+            error_lines.append(line.decode('utf-8', 'replace'))
+
+def tool_filename(file_path):
+    """Return the basename of a tool's file_path, interned.
+
+    Every Edit/Write of the same file then yields the very same string object, so the repeat
+    lookups in the per-file tracking succeed on identity without comparing characters.
+    """
+    return sys.intern(file_path.rpartition("/")[2] or file_path)
+
+def as_number(value):
+    """Return value if it is a number (as found in Claude's result event), else 0."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return 0
+
+def parse_stream_line(line, error_lines):
+    """Parse one line of Claude's stream-json output. Non-JSON lines are kept in error_lines."""
+    if not line or line.isspace():
+        return None
+    # Every event is a JSON object: turn stray text away on its first byte (the lstrip()
+    # fallback only runs for lines with leading whitespace) without raising
+    if line[0] != 0x7B and not line.lstrip().startswith(b"{"):
+        error_lines.append(line.strip().decode('utf-8', 'replace'))
+        return None
+    try:
+        return json_loads(line)  # Both parsers skip surrounding whitespace, no strip() copy needed
+    except ValueError:  # JSONDecodeError (stdlib and orjson) or invalid UTF-8
+        error_lines.append(line.strip().decode('utf-8', 'replace'))
+        return None
+
+def iter_stream_lines(pipe):
+    """Yield raw lines from a binary pipe, reading it in large blocks."""
+    pending = []  # Pieces of a line that spans several reads
+    while True:
+        chunk = pipe.read1(CLAUDE_PIPE_BUFFER_SIZE)
+        if not chunk:
+            break
+        if b"\n" not in chunk:
+            pending.append(chunk)
+            continue
+        lines = chunk.split(b"\n")
+        if pending:
+            pending.append(lines[0])
+            lines[0] = b"".join(pending)
+        pending = [lines.pop()]  # Partial last line (possibly empty)
+        yield from lines
+    if pending:
+        yield b"".join(pending)
+
+def pump_stream_lines(pipe, line_queue):
+    """Reader thread: move Claude's stdout lines into line_queue, then None at EOF.
+
+    Keeps pipe reads going while the main thread parses and handles events; the queue is
+    bounded, so a slow consumer pushes back on Claude through the pipe instead of using memory.
+    """
+    try:
+        for line in iter_stream_lines(pipe):
+            line_queue.put(line)
+    except (OSError, ValueError) as e:  # Pipe closed under us
+        print(f"Error reading process output: {e}", file=sys.stderr)
+    finally:
+        line_queue.put(None)
+
 def main():
     # Get Slack token from environment variable (security: not visible in ps aux)
     slack_token = os.environ.get('SLACK_TOKEN')
@@ -293,7 +810,11 @@ def main():
         print("Usage: SLACK_TOKEN=xoxb-... python3 claude-streamer.py <channel> <thread_ts> <message_ts> <session_id> <base64_message> [base64_files_json]")
         sys.exit(1)
 
-    if len(sys.argv) < 6:
+    # Optionally take the message from stdin and files JSON from FD 3 instead of base64 argv
+    use_stdin = os.environ.get('CLAUDE_MESSAGE_STDIN') == '1'
+    use_file_cache = os.environ.get('CLAUDE_FILE_CACHE') == '1'
+
+    if len(sys.argv) < (5 if use_stdin else 6):
         print("Usage: SLACK_TOKEN=xoxb-... python3 claude-streamer.py <channel> <thread_ts> <message_ts> <session_id> <base64_message> [base64_files_json]")
         print("  SLACK_TOKEN      - Slack Bot OAuth token (xoxb-...) - via environment variable")
         print("  channel          - Slack channel ID")
@@ -302,31 +823,42 @@ def main():
         print("  session_id       - Claude session UUID for conversation continuity")
         print("  base64_message   - User message encoded in base64")
         print("  base64_files_json - Optional: JSON array of file objects [{url_private, name, mimetype}] encoded in base64")
+        print("  CLAUDE_MESSAGE_STDIN=1 - Optional: read the message from stdin and files JSON from FD 3 (omit both base64 args)")
         sys.exit(1)
 
+    init_slack_session(slack_token)
+
     channel = sys.argv[1]
     thread_ts = sys.argv[2]
     message_ts = sys.argv[3]  # The actual message to react to
     session_id = sys.argv[4]
+    log_ctx = {"channel": channel, "session": session_id}  # Common log_event context
 
     # Decode and clean the message
-    raw_message = base64.b64decode(sys.argv[5]).decode('utf-8')
+    if use_stdin:
+        raw_message = sys.stdin.buffer.read().decode('utf-8')
+    else:
+        raw_message = base64.b64decode(sys.argv[5]).decode('utf-8')
 
     # Remove Slack mention patterns (e.g., <@U12345678>) since they add no meaning
-    message = re.sub(r'<@[A-Z0-9]+>', '', raw_message).strip()
+    message = MENTION_PATTERN.sub('', raw_message).strip()
 
     # Log session start
-    log_event("info", "Session started", channel=channel, session=session_id,
+    log_event("info", "Session started", **log_ctx,
               message_length=len(message))
 
     # Parse optional files argument
     files = []
-    if len(sys.argv) >= 7 and sys.argv[6]:
-        try:
-            files_json = base64.b64decode(sys.argv[6]).decode('utf-8')
-            files = json.loads(files_json) if files_json else []
-        except Exception as e:
-            print(f"Error parsing files: {e}", file=sys.stderr)
+    try:
+        # Kept as bytes: both JSON parsers take UTF-8 bytes directly, no decode copy needed
+        files_json = b""
+        if use_stdin and inherited_files_fd is not None:
+            files_json = read_inherited_fd(inherited_files_fd)
+        elif len(sys.argv) >= 7 and sys.argv[6]:
+            files_json = base64.b64decode(sys.argv[6])
+        files = json_loads(files_json) if files_json.strip() else []
+    except Exception as e:
+        print(f"Error parsing files: {e}", file=sys.stderr)
 
     # Reaction emojis
     PROCESSING_EMOJI = "hourglass_flowing_sand"
@@ -334,16 +866,18 @@ def main():
     ERROR_EMOJI = "x"
 
     # Add processing reaction to user's message
-    add_reaction(slack_token, channel, message_ts, PROCESSING_EMOJI)
+    processing_reaction = add_reaction(channel, message_ts, PROCESSING_EMOJI)
 
     # Create temp directory for downloaded files with secure permissions
-    # Use user-specific runtime directory when available (more secure, RAM-based)
-    uid = os.getuid()
-    runtime_dir = f"/run/user/{uid}" if os.path.exists(f"/run/user/{uid}") else None
-    temp_dir = tempfile.mkdtemp(prefix="claude_slack_", dir=runtime_dir)
+    # Prefer a RAM-based (tmpfs) location so attachments only reach disk if CLAUDE_FILE_CACHE=1
+    temp_dir = tempfile.mkdtemp(prefix="claude_slack_", dir=get_scratch_base_dir())
     # Restrict permissions to owner only (rwx------)
     os.chmod(temp_dir, stat.S_IRWXU)
     downloaded_files = []
+    progress = ProgressBatcher(channel, thread_ts)  # Batched tool/download notices
+    process = None  # Claude subprocess, once started
+    signal.signal(signal.SIGTERM, exit_on_signal)
+    signal.signal(signal.SIGHUP, exit_on_signal)
 
     try:
         # Filter to supported files only and check count limit
@@ -357,10 +891,11 @@ def main():
             if not file_url:
                 continue
 
-            # Check if it's a supported file type
-            ext = os.path.splitext(file_name)[1].lower()
-            is_image = ext in IMAGE_EXTENSIONS or mimetype.startswith('image/')
-            is_pdf = ext in PDF_EXTENSIONS or mimetype == 'application/pdf'
+            # Check if it's a supported file type (mimetype first, it needs no string building)
+            _, dot, ext = file_name.rpartition('.')
+            ext = ext.lower() if dot else ''
+            is_image = mimetype.startswith('image/') or ext in IMAGE_EXTENSIONS
+            is_pdf = mimetype == 'application/pdf' or ext in PDF_EXTENSIONS
 
             if is_image or is_pdf:
                 supported_files.append({
@@ -373,73 +908,81 @@ def main():
 
         # Check file count limit
         if len(supported_files) > MAX_FILE_COUNT:
-            send_slack(slack_token, channel, thread_ts,
+            send_slack(channel, thread_ts,
                 f"Too many files attached ({len(supported_files)}). Maximum is {MAX_FILE_COUNT} files per message. Processing first {MAX_FILE_COUNT} only.")
             supported_files = supported_files[:MAX_FILE_COUNT]
 
-        # Download supported files (images and PDFs)
-        for file_info in supported_files:
-            file_url = file_info['url']
-            file_name = file_info['name']
-            file_size = file_info['size']
-            is_image = file_info['is_image']
-            file_type = "image" if is_image else "PDF"
-
-            # Check file size from Slack metadata first (before downloading)
-            if file_size and file_size > MAX_FILE_SIZE_BYTES:
-                size_mb = file_size / (1024 * 1024)
-                send_slack(slack_token, channel, thread_ts,
-                    f"Skipped {file_type} `{file_name}`: {size_mb:.1f}MB exceeds {MAX_FILE_SIZE_MB}MB limit")
-                continue
+        # Download supported files (images and PDFs) concurrently
+        # Slack notifications stay on the main thread, in attachment order
+        with ThreadPoolExecutor(max_workers=max(1, len(supported_files))) as executor:
+            downloads = []
+            used_names = set()  # Local file names already taken in temp_dir
+            for file_info in supported_files:
+                file_name = file_info['name']
+                file_size = file_info['size']
+                file_type = "image" if file_info['is_image'] else "PDF"
+
+                # Check file size from Slack metadata first (before downloading)
+                if file_size and file_size > MAX_FILE_SIZE_BYTES:
+                    size_mb = file_size / (1024 * 1024)
+                    progress.add(f"Skipped {file_type} `{file_name}`: {size_mb:.1f}MB exceeds {MAX_FILE_SIZE_MB}MB limit")
+                    continue
 
-            dest_path = os.path.join(temp_dir, file_name)
-            success, error = download_slack_file(slack_token, file_url, dest_path)
-            if success:
-                downloaded_files.append({
-                    'path': dest_path,
-                    'name': file_name,
-                    'type': 'image' if is_image else 'pdf'
-                })
-                send_slack(slack_token, channel, thread_ts, f"Downloaded {file_type}: `{file_name}`")
-                log_event("info", f"File downloaded: {file_name}", channel=channel, session=session_id,
-                          file_type=file_type)
-            elif error == "exceeds_size_limit":
-                send_slack(slack_token, channel, thread_ts,
-                    f"Skipped {file_type} `{file_name}`: exceeds {MAX_FILE_SIZE_MB}MB limit")
-                log_event("warning", f"File rejected (size limit): {file_name}", channel=channel, session=session_id)
-            else:
-                send_slack(slack_token, channel, thread_ts, f"Failed to download {file_type}: `{file_name}`")
-                log_event("error", f"File download failed: {file_name}", channel=channel, session=session_id)
+                # Each download gets its own path; the Slack name is still what users see
+                local_name = unique_file_name(file_name.rpartition('/')[2] or 'file', used_names)
+                dest_path = temp_dir + "/" + local_name  # temp_dir comes from mkdtemp, no trailing slash
+                if use_file_cache:
+                    future = executor.submit(cached_download, file_info['url'], file_name, file_size, dest_path)
+                else:
+                    future = executor.submit(download_slack_file, file_info['url'], dest_path)
+                downloads.append((future, file_info, dest_path))
+
+            for future, file_info, dest_path in downloads:
+                file_name = file_info['name']
+                is_image = file_info['is_image']
+                file_type = "image" if is_image else "PDF"
+
+                success, error = future.result()
+                if success:
+                    downloaded_files.append({
+                        'path': dest_path,
+                        'name': file_name,
+                        'type': 'image' if is_image else 'pdf'
+                    })
+                    progress.add(f"Downloaded {file_type}: `{file_name}`")
+                    log_event("info", f"File downloaded: {file_name}", **log_ctx,
+                              file_type=file_type)
+                elif error == "exceeds_size_limit":
+                    progress.add(f"Skipped {file_type} `{file_name}`: exceeds {MAX_FILE_SIZE_MB}MB limit")
+                    log_event("warning", f"File rejected (size limit): {file_name}", **log_ctx)
+                else:
+                    progress.add(f"Failed to download {file_type}: `{file_name}`")
+                    log_event("error", f"File download failed: {file_name}", **log_ctx)
+
+        # One Slack message for all attachment notices
+        progress.flush()
+        if use_file_cache and downloads:
+            prune_file_cache()  # Once per run, across every bucket
 
         # Build the message with file references
         # If files were downloaded, prepend instructions to read them
         full_message = message
         if downloaded_files:
-            file_instructions = []
-            for f in downloaded_files:
-                file_instructions.append(f"- {f['type'].upper()}: {f['path']}")
-
-            files_text = "\n".join(file_instructions)
+            files_text = "\n".join(f"- {f['type'].upper()}: {f['path']}" for f in downloaded_files)
             if message:
-                full_message = f"""The user has attached the following file(s). Please read and analyze them as part of your response:
-
-{files_text}
-
-User's message: {message}"""
+                full_message = FILES_PROMPT_TEMPLATE.format(files_text=files_text, message=message)
             else:
                 # No text message, just files - ask Claude to analyze them
-                full_message = f"""The user has attached the following file(s). Please read and analyze them:
-
-{files_text}"""
+                full_message = FILES_ONLY_PROMPT_TEMPLATE.format(files_text=files_text)
 
         # Validate that we have a meaningful message to send
         # Check for empty, whitespace-only, or effectively empty content
         if not full_message or not full_message.strip():
             # User just mentioned the bot without a message - give them a friendly prompt
-            send_slack(slack_token, channel, thread_ts, "Hey! How can I help you? Just type your question or request after mentioning me.")
-            remove_reaction(slack_token, channel, message_ts, PROCESSING_EMOJI)
-            add_reaction(slack_token, channel, message_ts, SUCCESS_EMOJI)  # Not an error, just a prompt
-            log_event("info", "Empty message - sent help prompt", channel=channel, session=session_id,
+            progress.drain()
+            send_slack(channel, thread_ts, "Hey! How can I help you? Just type your question or request after mentioning me.")
+            replace_reaction(channel, message_ts, PROCESSING_EMOJI, SUCCESS_EMOJI, after=processing_reaction)  # Not an error, just a prompt
+            log_event("info", "Empty message - sent help prompt", **log_ctx,
                       raw_length=len(raw_message) if 'raw_message' in dir() else 0)
             return
 
@@ -464,47 +1007,55 @@ User's message: {message}"""
         # Track start time for duration calculation if result event is missing
         start_time = time.time()
 
-        # Try --session-id first, if it fails with "already in use", switch to --resume
-        cmd = build_cmd(use_session_id=True)
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        error_lines = []  # Capture stderr and non-JSON output for debugging
 
-        # Peek at first line to check for session error
-        first_line = process.stdout.readline()
-        if first_line and "already in use" in first_line:
-            # Session exists, use --resume instead
-            process.kill()
-            process.wait()
-            cmd = build_cmd(use_session_id=False)
-            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-            first_line = None  # Don't process this line again
+        # Pick --session-id or --resume up front to avoid spawning Claude twice: cached sessions
+        # are resumed. Otherwise (from before the cache, compacted away, or never answered) a
+        # message that starts its own thread opens a new session and replies resume one.
+        known_sessions = load_known_sessions()
+        is_new_session = session_id not in known_sessions and thread_ts == message_ts
+        cmd = build_cmd(use_session_id=is_new_session)
+        process, stderr_thread = start_claude(cmd, error_lines)
 
-        # Start safe word monitor
-        safe_word_monitor = SafeWordMonitor(slack_token, channel, thread_ts, message_ts)
+        # Start safe word monitor (before the peek, so a slow Claude start can still be stopped;
+        # it keeps running across a fallback respawn)
+        safe_word_monitor = SafeWordMonitor(channel, thread_ts, message_ts)
         safe_word_monitor.start()
         was_stopped = False  # Track if process was killed by safe word
 
+        # Peek at first line to check for session error
+        session_error = "already in use" if is_new_session else "No conversation found"
+        first_line = peek_first_line(process, error_lines, session_error, safe_word_monitor)
+        if first_line == b"":
+            # Claude exited without output - wait for its stderr to be fully drained
+            stderr_thread.join(timeout=5)
+        if (first_line and session_error.encode() in first_line) or any(session_error in l for l in error_lines):
+            # Guessed wrong (e.g. thread started before the bot joined) - retry with the other flag
+            log_event("warning", f"Session flag fallback: {session_error}", **log_ctx)
+            kill_claude(process)
+            process.wait()
+            stderr_thread.join(timeout=5)
+            error_lines.clear()
+            cmd = build_cmd(use_session_id=not is_new_session)
+            process, stderr_thread = start_claude(cmd, error_lines)
+            first_line = None  # Don't process this line again
+
         # Track actions
-        edits = 0
-        writes = 0
-        reads = 0
-        commands = 0
-        globs = 0
-        greps = 0
-        web_fetches = 0
-        web_searches = 0
-        tasks = 0
-        mcp_calls = 0
+        counts = Counter()  # Tool use counters, keyed by the names in SUMMARY_SPECS
         final_result = ""
         result_stats = {}  # Will capture cost, duration, tokens from result event
-        reported_files = set()  # Avoid duplicate reports
+        file_actions = {}  # Filename -> {"edit", "write"}; announced once, listed in the summary
         reported_actions = set()  # Avoid duplicate action reports
-        error_lines = []  # Capture non-JSON output for debugging
 
         # Streaming text state
-        streaming_text = ""  # Accumulated text from assistant messages
+        streaming_parts = []  # Accumulated text from assistant messages (joined only when sending)
+        streaming_len = 0  # Total length of streaming_parts
         streaming_msg_ts = None  # Slack message ts for updates
         last_stream_update = 0  # Timestamp of last Slack update
         last_streamed_len = 0  # Length of text at last update
+        recent_updates = deque(maxlen=STREAM_BURST_MAX)  # Timestamps (ms) of the latest updates
+        last_sent_hash = None  # Hash of the text the streaming message currently shows
+        pending_update = None  # Future of the in-flight background chat.update
 
         # Track continuation messages for very long responses
         continuation_count = 0
@@ -512,50 +1063,79 @@ User's message: {message}"""
         # Track all messages for long responses (list of ts values)
         all_message_ts_list = []
 
+        # Helper functions to accumulate streaming text without quadratic string concatenation
+        def append_stream_text(text):
+            nonlocal streaming_len
+            streaming_parts.append(text)
+            streaming_len += len(text)
+
+        def get_stream_text():
+            if len(streaming_parts) > 1:
+                # Collapse into a single part so the next join only copies new text once
+                streaming_parts[:] = ["".join(streaming_parts)]
+            return streaming_parts[0] if streaming_parts else ""
+
+        def finish_pending_update():
+            """Wait for the in-flight background update so Slack sees updates in order."""
+            nonlocal pending_update, last_sent_hash
+            if pending_update is not None:
+                if not pending_update.result():
+                    last_sent_hash = None  # Unknown what the message shows now, don't dedup against it
+                pending_update = None
+
         # Helper function to update streaming message in Slack
         def update_stream_if_needed(force=False):
-            nonlocal streaming_msg_ts, last_stream_update, last_streamed_len, streaming_text, continuation_count, all_message_ts_list
-            now = time.time() * 1000  # Current time in ms
+            nonlocal streaming_msg_ts, last_stream_update, last_streamed_len, streaming_len, continuation_count, all_message_ts_list
+            nonlocal last_sent_hash, pending_update
+
+            # Cheap check first using the running length: most text deltas are too small to send
+            new_chars = streaming_len - last_streamed_len
+            if not force and new_chars < STREAM_MIN_CHARS:
+                return True  # Nothing to do is success
 
-            # Check if we should update
-            new_chars = len(streaming_text) - last_streamed_len
+            now = time.time() * 1000  # Current time in ms
             time_elapsed = now - last_stream_update
 
             should_update = force or (
-                new_chars >= STREAM_MIN_CHARS and
-                time_elapsed >= STREAM_UPDATE_INTERVAL_MS
+                time_elapsed >= STREAM_UPDATE_INTERVAL_MS and
+                now >= slack_rate_limited_until * 1000 and
+                # Allow short bursts, then cool down until the window slides
+                not (len(recent_updates) == STREAM_BURST_MAX and
+                     now - recent_updates[0] < STREAM_BURST_WINDOW_MS)
             )
 
-            if not should_update or not streaming_text:
+            if not should_update or not streaming_len:
                 return True  # Nothing to do is success
 
+            if pending_update is not None:
+                if not force and not pending_update.done():
+                    return True  # Previous update still in flight; the next one carries the newer text
+                finish_pending_update()
+
             # Add typing indicator if not final update
-            display_text = streaming_text + (STREAM_TYPING_INDICATOR if not force else "")
+            indicator = STREAM_TYPING_INDICATOR if not force else ""
 
             # Use longer timeout for final updates (force=True)
             update_timeout = 30 if force else 10
 
-            # Check if message is getting too long for Slack
-            # Use a safe cutoff point to avoid splitting mid-word
-            SAFE_CUTOFF = SLACK_MAX_MESSAGE_LENGTH - 200  # Extra buffer for continuation text
-
-            if len(display_text) > SLACK_MAX_MESSAGE_LENGTH:
-                # Find a good break point (end of line or space) near the safe cutoff
-                break_point = SAFE_CUTOFF
-                # Try to find a newline near the break point
-                newline_pos = streaming_text.rfind('\n', SAFE_CUTOFF - 500, SAFE_CUTOFF)
+            # Check if message is getting too long for Slack (decided from lengths alone)
+            if streaming_len + (0 if force else STREAM_TYPING_INDICATOR_LENGTH) > SLACK_MAX_MESSAGE_LENGTH:
+                streaming_text = get_stream_text()
+                # Find a good break point (end of line or space) near the safe cutoff,
+                # only scanning a small window before it
+                break_point = STREAM_SAFE_CUTOFF
+                newline_pos = streaming_text.rfind('\n', STREAM_SAFE_CUTOFF - STREAM_NEWLINE_SEARCH_WINDOW, STREAM_SAFE_CUTOFF)
                 if newline_pos > 0:
                     break_point = newline_pos
                 else:
-                    # Try to find a space
-                    space_pos = streaming_text.rfind(' ', SAFE_CUTOFF - 100, SAFE_CUTOFF)
+                    space_pos = streaming_text.rfind(' ', STREAM_SAFE_CUTOFF - STREAM_SPACE_SEARCH_WINDOW, STREAM_SAFE_CUTOFF)
                     if space_pos > 0:
                         break_point = space_pos
 
                 # Finalize current message and start a new one
                 if streaming_msg_ts:
                     finalized_text = streaming_text[:break_point] + "\n\n_[Continued in next message...]_"
-                    update_slack_message(slack_token, channel, streaming_msg_ts, finalized_text, timeout=update_timeout)
+                    update_slack_message(channel, streaming_msg_ts, finalized_text, timeout=update_timeout)
                     all_message_ts_list.append(streaming_msg_ts)
 
                 # Keep the remainder for the continuation
@@ -564,155 +1144,187 @@ User's message: {message}"""
                 # Reset for continuation
                 continuation_count += 1
                 streaming_text = f"_[Continuation {continuation_count}]_\n\n" + remainder
+                streaming_parts[:] = [streaming_text]
+                streaming_len = len(streaming_text)
                 streaming_msg_ts = None
                 last_streamed_len = 0
 
-                # Recalculate display_text with new streaming_text
-                display_text = streaming_text + (STREAM_TYPING_INDICATOR if not force else "")
+            # Only build the outgoing text once we know we are sending it
+            display_text = get_stream_text() + indicator
+            display_hash = hash(display_text)
+
+            # Skip the API call if the message already shows exactly this text
+            # (e.g. a forced update right after another one, with no new text in between)
+            if streaming_msg_ts and display_hash == last_sent_hash:
+                last_streamed_len = streaming_len
+                return True
 
             update_success = False
-            if streaming_msg_ts:
+            if streaming_msg_ts and not force:
+                # Update existing message in the background (checked by finish_pending_update)
+                pending_update = slack_post_pool.submit(update_slack_message, channel, streaming_msg_ts,
+                                                           display_text, update_timeout)
+                last_sent_hash = display_hash
+                update_success = True
+            elif streaming_msg_ts:
                 # Update existing message
-                update_success = update_slack_message(slack_token, channel, streaming_msg_ts, display_text, timeout=update_timeout)
-                if not update_success and force:
+                update_success = update_slack_message(channel, streaming_msg_ts, display_text, timeout=update_timeout)
+                if update_success:
+                    last_sent_hash = display_hash
+                elif force:
                     # Final update failed on existing message - log for debugging
                     print(f"Final update failed for ts={streaming_msg_ts}, text_len={len(display_text)}", file=sys.stderr)
             else:
-                # Create new streaming message
-                new_ts = send_slack(slack_token, channel, thread_ts, display_text)
+                # Create new streaming message, after any queued progress lines
+                progress.drain()
+                new_ts = send_slack(channel, thread_ts, display_text)
                 if new_ts:
                     streaming_msg_ts = new_ts
+                    last_sent_hash = display_hash
                     update_success = True
                 else:
                     print(f"Failed to create new streaming message, text_len={len(display_text)}", file=sys.stderr)
 
             last_stream_update = now
-            last_streamed_len = len(streaming_text)
+            recent_updates.append(now)
+            last_streamed_len = streaming_len
             return update_success
 
-        # Helper function to process a single line
-        def process_line(line):
-            nonlocal edits, writes, reads, commands, globs, greps, web_fetches, web_searches, tasks, mcp_calls, final_result, result_stats
-            nonlocal streaming_text
-            line = line.strip()
-            if not line:
-                return
-
-            try:
-                data = json.loads(line)
-            except json.JSONDecodeError:
-                error_lines.append(line)
-                return
-
+        # Tool handlers, dispatched by tool name from process_event
+        def handle_edit(tool_input):
+            counts["edits"] += 1
+            file_path = tool_input.get("file_path", "")
+            if file_path:
+                filename = tool_filename(file_path)
+                actions = file_actions.get(filename)
+                if actions is None:
+                    file_actions[filename] = {"edit"}
+                    # Append to streaming text
+                    append_stream_text(f"\n_Editing `{filename}`..._\n")
+                    update_stream_if_needed(force=True)
+                    log_event("info", f"Tool: Edit {filename}", **log_ctx)
+                else:
+                    actions.add("edit")
+
+        def handle_write(tool_input):
+            counts["writes"] += 1
+            file_path = tool_input.get("file_path", "")
+            if file_path:
+                filename = tool_filename(file_path)
+                actions = file_actions.get(filename)
+                if actions is None:
+                    file_actions[filename] = {"write"}
+                    # Append to streaming text
+                    append_stream_text(f"\n_Creating `{filename}`..._\n")
+                    update_stream_if_needed(force=True)
+                    log_event("info", f"Tool: Write {filename}", **log_ctx)
+                else:
+                    actions.add("write")
+
+        def handle_read(tool_input):
+            counts["reads"] += 1
+            # Log reads but don't spam (already silent in Slack)
+            log_event("info", f"Tool: Read", **log_ctx)
+
+        def handle_bash(tool_input):
+            cmd_str = tool_input.get("command", "")
+            if cmd_str and not BASH_SKIP_PATTERN.match(cmd_str):
+                counts["commands"] += 1
+                display_cmd = cmd_str[:50] + "..." if len(cmd_str) > 50 else cmd_str
+                # Append to streaming text
+                append_stream_text(f"\n_Running `{display_cmd}`..._\n")
+                update_stream_if_needed(force=True)
+                log_event("info", f"Tool: Bash {display_cmd}", **log_ctx)
+
+        def handle_glob(tool_input):
+            counts["globs"] += 1
+            pattern = tool_input.get("pattern", "")
+            if pattern and "glob" not in reported_actions:
+                reported_actions.add("glob")
+                progress.add(f"Searching for files `{pattern}`...")
+                log_event("info", f"Tool: Glob {pattern}", **log_ctx)
+
+        def handle_grep(tool_input):
+            counts["greps"] += 1
+            pattern = tool_input.get("pattern", "")
+            if pattern and "grep" not in reported_actions:
+                reported_actions.add("grep")
+                progress.add(f"Searching in files for `{pattern[:30]}`...")
+                log_event("info", f"Tool: Grep {pattern}", **log_ctx)
+
+        def handle_web_fetch(tool_input):
+            counts["web_fetches"] += 1
+            url = tool_input.get("url", "")
+            if url:
+                # Show domain only for brevity
+                domain = url.partition("://")[2].partition("/")[0] or url
+                progress.add(f"Fetching `{domain}`...")
+                log_event("info", f"Tool: WebFetch {domain}", **log_ctx)
+
+        def handle_web_search(tool_input):
+            counts["web_searches"] += 1
+            query = tool_input.get("query", "")
+            if query:
+                display_query = query[:40] + "..." if len(query) > 40 else query
+                progress.add(f"Searching the web: `{display_query}`...")
+                log_event("info", f"Tool: WebSearch {query}", **log_ctx)
+
+        def handle_task(tool_input):
+            counts["tasks"] += 1
+            description = tool_input.get("description", "agent task")
+            progress.add(f"Spawning agent: {description}...")
+            log_event("info", f"Tool: Task {description}", **log_ctx)
+
+        def handle_mcp(tool_name):
+            counts["mcp_calls"] += 1
+            # Parse MCP tool name: mcp__server__action
+            parts = tool_name.split("__")
+            if len(parts) >= 3:
+                server = parts[1]
+                action = parts[2]
+                action_key = f"mcp_{server}"
+                if action_key not in reported_actions:
+                    reported_actions.add(action_key)
+                    progress.add(f"Calling {server}: {action}...")
+                    log_event("info", f"Tool: MCP {server} {action}", **log_ctx)
+
+        tool_handlers = {
+            "Edit": handle_edit,
+            "Write": handle_write,
+            "Read": handle_read,
+            "Bash": handle_bash,
+            "Glob": handle_glob,
+            "Grep": handle_grep,
+            "WebFetch": handle_web_fetch,
+            "WebSearch": handle_web_search,
+            "Task": handle_task,
+        }
+
+        # Helper function to process a single stream-json event
+        def process_event(data):
+            nonlocal final_result, result_stats
+            event_type = data.get("type")
             # Handle assistant messages (both tool_use and text)
-            if data.get("type") == "assistant" and "message" in data:
-                content = data["message"].get("content", [])
+            if event_type == "assistant" and "message" in data:
+                content = data["message"].get("content") or ()  # No default list built per event
 
-                # Extract text content for streaming
+                # Single pass over content: stream text, dispatch tool uses (in message order)
                 for item in content:
-                    if item.get("type") == "text":
+                    item_type = item.get("type")
+                    if item_type == "text":
                         text_chunk = item.get("text", "")
                         if text_chunk:
-                            streaming_text += text_chunk
+                            append_stream_text(text_chunk)
                             update_stream_if_needed()
-                for item in content:
-                    if item.get("type") == "tool_use":
+                    elif item_type == "tool_use":
                         tool_name = item.get("name", "")
-                        tool_input = item.get("input", {})
-
-                        if tool_name == "Edit":
-                            edits += 1
-                            file_path = tool_input.get("file_path", "")
-                            if file_path:
-                                filename = file_path.split("/")[-1]
-                                if filename not in reported_files:
-                                    reported_files.add(filename)
-                                    # Append to streaming text
-                                    streaming_text += f"\n_Editing `{filename}`..._\n"
-                                    update_stream_if_needed(force=True)
-                                    log_event("info", f"Tool: Edit {filename}", channel=channel, session=session_id)
-
-                        elif tool_name == "Write":
-                            writes += 1
-                            file_path = tool_input.get("file_path", "")
-                            if file_path:
-                                filename = file_path.split("/")[-1]
-                                if filename not in reported_files:
-                                    reported_files.add(filename)
-                                    # Append to streaming text
-                                    streaming_text += f"\n_Creating `{filename}`..._\n"
-                                    update_stream_if_needed(force=True)
-                                    log_event("info", f"Tool: Write {filename}", channel=channel, session=session_id)
-
-                        elif tool_name == "Read":
-                            reads += 1
-                            # Log reads but don't spam (already silent in Slack)
-                            log_event("info", f"Tool: Read", channel=channel, session=session_id)
-
-                        elif tool_name == "Bash":
-                            cmd_str = tool_input.get("command", "")
-                            skip_prefixes = ("cat ", "head ", "tail ", "ls ", "pwd", "echo ", "grep ", "find ", "source ")
-                            if cmd_str and not cmd_str.startswith(skip_prefixes):
-                                commands += 1
-                                display_cmd = cmd_str[:50] + "..." if len(cmd_str) > 50 else cmd_str
-                                # Append to streaming text
-                                streaming_text += f"\n_Running `{display_cmd}`..._\n"
-                                update_stream_if_needed(force=True)
-                                log_event("info", f"Tool: Bash {display_cmd}", channel=channel, session=session_id)
-
-                        elif tool_name == "Glob":
-                            globs += 1
-                            pattern = tool_input.get("pattern", "")
-                            if pattern and "glob" not in reported_actions:
-                                reported_actions.add("glob")
-                                send_slack(slack_token, channel, thread_ts, f"Searching for files `{pattern}`...")
-                                log_event("info", f"Tool: Glob {pattern}", channel=channel, session=session_id)
-
-                        elif tool_name == "Grep":
-                            greps += 1
-                            pattern = tool_input.get("pattern", "")
-                            if pattern and "grep" not in reported_actions:
-                                reported_actions.add("grep")
-                                send_slack(slack_token, channel, thread_ts, f"Searching in files for `{pattern[:30]}`...")
-                                log_event("info", f"Tool: Grep {pattern}", channel=channel, session=session_id)
-
-                        elif tool_name == "WebFetch":
-                            web_fetches += 1
-                            url = tool_input.get("url", "")
-                            if url:
-                                # Show domain only for brevity
-                                domain = url.split("/")[2] if "/" in url else url
-                                send_slack(slack_token, channel, thread_ts, f"Fetching `{domain}`...")
-                                log_event("info", f"Tool: WebFetch {domain}", channel=channel, session=session_id)
-
-                        elif tool_name == "WebSearch":
-                            web_searches += 1
-                            query = tool_input.get("query", "")
-                            if query:
-                                display_query = query[:40] + "..." if len(query) > 40 else query
-                                send_slack(slack_token, channel, thread_ts, f"Searching the web: `{display_query}`...")
-                                log_event("info", f"Tool: WebSearch {query}", channel=channel, session=session_id)
-
-                        elif tool_name == "Task":
-                            tasks += 1
-                            description = tool_input.get("description", "agent task")
-                            send_slack(slack_token, channel, thread_ts, f"Spawning agent: {description}...")
-                            log_event("info", f"Tool: Task {description}", channel=channel, session=session_id)
-
+                        handler = tool_handlers.get(tool_name)
+                        if handler:
+                            handler(item.get("input") or {})  # Empty dict only built when input is missing
                         elif tool_name.startswith("mcp__"):
-                            mcp_calls += 1
-                            # Parse MCP tool name: mcp__server__action
-                            parts = tool_name.split("__")
-                            if len(parts) >= 3:
-                                server = parts[1]
-                                action = parts[2]
-                                action_key = f"mcp_{server}"
-                                if action_key not in reported_actions:
-                                    reported_actions.add(action_key)
-                                    send_slack(slack_token, channel, thread_ts, f"Calling {server}: {action}...")
-                                    log_event("info", f"Tool: MCP {server} {action}", channel=channel, session=session_id)
-
-            if data.get("type") == "result":
+                            handle_mcp(tool_name)
+
+            elif event_type == "result":
                 final_result = data.get("result", "")
                 # Capture stats from result event
                 result_stats["duration_ms"] = data.get("duration_ms", 0)
@@ -721,25 +1333,61 @@ User's message: {message}"""
 
         # Process first line if we have one
         if first_line:
-            process_line(first_line)
+            first_event = parse_stream_line(first_line, error_lines)
+            if first_event is not None:
+                process_event(first_event)
+                progress.maybe_flush()
+
+        # A reader thread drains stdout while this thread parses and posts
+        line_queue = queue.Queue(maxsize=STREAM_QUEUE_MAX_LINES)
+        reader_thread = threading.Thread(target=pump_stream_lines, args=(process.stdout, line_queue), daemon=True)
+        reader_thread.start()
 
         try:
-            for line in process.stdout:
-                # Check safe word before processing each line
+            idle_timeout = STREAM_IDLE_POLL_MIN
+            while True:
+                try:
+                    line = line_queue.get(timeout=idle_timeout)
+                except queue.Empty:
+                    # Claude is silent (thinking, long tool call): still check the safe word
+                    # and send text the throttle held back, instead of waiting for the next line
+                    line = b""
+                    idle_timeout = min(idle_timeout * 2, STREAM_IDLE_POLL_MAX)
+                else:
+                    if line is None:
+                        break
+                    idle_timeout = STREAM_IDLE_POLL_MIN
+                event = parse_stream_line(line, error_lines)
+                # Check safe word before processing each event
                 if safe_word_monitor.triggered:
                     was_stopped = True
-                    process.kill()
+                    kill_claude(process)
                     log_event("info", f"Safe word triggered by user {safe_word_monitor.trigger_user}",
-                              channel=channel, session=session_id)
+                              **log_ctx)
                     break
-                process_line(line)
+                if event is None:
+                    if not line:
+                        update_stream_if_needed()
+                    continue
+                process_event(event)
+                progress.maybe_flush()
         except Exception as e:
             print(f"Error reading process output: {e}", file=sys.stderr)
-            log_event("error", f"Error reading output: {e}", channel=channel, session=session_id)
+            log_event("error", f"Error reading output: {e}", **log_ctx)
+            # Nobody reads line_queue any more: once the pipe filled, Claude would block on
+            # its next write and process.wait() below would never return
+            kill_claude(process)
 
         process.wait()
+        stderr_thread.join(timeout=5)
         safe_word_monitor.stop()
 
+        # Claude produced a response, so the session exists now - resume it next time
+        if (streaming_len or final_result) and session_id not in known_sessions:
+            remember_session(session_id)
+        progress.drain()
+        finish_pending_update()
+
         # Calculate duration if not captured from result event
         if not result_stats.get("duration_ms"):
             result_stats["duration_ms"] = int((time.time() - start_time) * 1000)
@@ -747,35 +1395,34 @@ User's message: {message}"""
         # Handle safe word stop
         if was_stopped:
             # Finalize whatever text we have so far
-            if streaming_text:
-                streaming_text += "\n\n:octagonal_sign: *Stopped by user*"
+            if streaming_len:
+                append_stream_text("\n\n:octagonal_sign: *Stopped by user*")
                 update_stream_if_needed(force=True)
             else:
-                send_slack(slack_token, channel, thread_ts, ":octagonal_sign: *Stopped by user*")
+                send_slack(channel, thread_ts, ":octagonal_sign: *Stopped by user*")
 
             # Reactions
-            remove_reaction(slack_token, channel, message_ts, PROCESSING_EMOJI)
-            add_reaction(slack_token, channel, message_ts, "octagonal_sign")
+            replace_reaction(channel, message_ts, PROCESSING_EMOJI, "octagonal_sign", after=processing_reaction)
 
             # Stats
             duration_ms = result_stats.get("duration_ms", 0)
             if duration_ms:
-                send_slack(slack_token, channel, thread_ts,
+                send_slack(channel, thread_ts,
                     f"_Cancelled after {duration_ms/1000:.1f}s_")
 
-            log_event("info", "Session stopped by safe word", channel=channel, session=session_id,
+            log_event("info", "Session stopped by safe word", **log_ctx,
                       duration_ms=duration_ms)
             return  # Skip normal completion flow
 
         # Final update to streaming message (remove typing indicator)
-        # This is critical - retry up to 3 times if it fails
-        if streaming_text:
+        # This is critical - retry up to FINAL_UPDATE_ATTEMPTS times if it fails
+        if streaming_len:
             final_update_success = False
-            for attempt in range(3):
+            for attempt in range(FINAL_UPDATE_ATTEMPTS):
                 try:
                     # Get current state before update
                     current_ts = streaming_msg_ts
-                    current_text_len = len(streaming_text)
+                    current_text_len = streaming_len
 
                     result = update_stream_if_needed(force=True)
 
@@ -783,102 +1430,80 @@ User's message: {message}"""
                     if result:
                         final_update_success = True
                         log_event("info", f"Final streaming update succeeded on attempt {attempt + 1}",
-                                  channel=channel, session=session_id, text_len=current_text_len,
+                                  **log_ctx, text_len=current_text_len,
                                   msg_ts=streaming_msg_ts)
                         break
                     else:
                         log_event("warning", f"Final update attempt {attempt + 1} returned False",
-                                  channel=channel, session=session_id, msg_ts=current_ts)
-                        time.sleep(1)  # Pause before retry
+                                  **log_ctx, msg_ts=current_ts)
                 except Exception as e:
                     log_event("error", f"Final update attempt {attempt + 1} exception: {e}",
-                              channel=channel, session=session_id)
-                    time.sleep(1)  # Brief pause before retry
+                              **log_ctx)
+                if attempt < FINAL_UPDATE_ATTEMPTS - 1:
+                    time.sleep(final_update_backoff(attempt))  # Pause before retry
 
             if not final_update_success:
                 log_event("error", "All final update attempts failed - sending fallback message",
-                          channel=channel, session=session_id, text_len=len(streaming_text))
+                          **log_ctx, text_len=streaming_len)
                 # Fallback: send the final text as a new message if update completely failed
                 # Send just the last portion if it's too long
-                fallback_text = streaming_text
-                if len(fallback_text) > SLACK_MAX_MESSAGE_LENGTH:
-                    fallback_text = "...\n\n" + streaming_text[-(SLACK_MAX_MESSAGE_LENGTH - 10):]
-                fallback_ts = send_slack(slack_token, channel, thread_ts, fallback_text)
+                fallback_text = get_stream_text()
+                if streaming_len > SLACK_MAX_MESSAGE_LENGTH:
+                    fallback_text = "...\n\n" + fallback_text[-(SLACK_MAX_MESSAGE_LENGTH - 10):]
+                fallback_ts = send_slack(channel, thread_ts, fallback_text)
                 if fallback_ts:
-                    log_event("info", "Fallback message sent successfully", channel=channel, session=session_id)
+                    log_event("info", "Fallback message sent successfully", **log_ctx)
                 else:
-                    log_event("error", "Fallback message also failed!", channel=channel, session=session_id)
-
-        # Send summary if work was done (wrapped in try/except to ensure we always reach reactions)
-        summary_parts = []
-        try:
-            if reads > 0:
-                summary_parts.append(f"read {reads} file(s)")
-            if edits > 0:
-                summary_parts.append(f"edited {edits} file(s)")
-            if writes > 0:
-                summary_parts.append(f"created {writes} file(s)")
-            if commands > 0:
-                summary_parts.append(f"ran {commands} command(s)")
-            if globs > 0:
-                summary_parts.append(f"searched {globs} pattern(s)")
-            if greps > 0:
-                summary_parts.append(f"grepped {greps} time(s)")
-            if web_fetches > 0:
-                summary_parts.append(f"fetched {web_fetches} URL(s)")
-            if web_searches > 0:
-                summary_parts.append(f"web searched {web_searches} time(s)")
-            if tasks > 0:
-                summary_parts.append(f"spawned {tasks} agent(s)")
-            if mcp_calls > 0:
-                summary_parts.append(f"called {mcp_calls} MCP tool(s)")
-
-            if summary_parts:
-                send_slack(slack_token, channel, thread_ts, f"Done: {', '.join(summary_parts)}")
-
-            # Send stats (duration is always available now via start_time fallback)
-            # Note: cost and tokens may be missing if Claude was interrupted before result event
-            stats_parts = []
-            duration_ms = result_stats.get("duration_ms", 0)
-            if duration_ms:
-                duration_sec = duration_ms / 1000
-                stats_parts.append(f"{duration_sec:.1f}s")
-            if result_stats.get("cost"):
-                cost = result_stats["cost"]
-                stats_parts.append(f"${cost:.4f}")
-            usage = result_stats.get("usage", {})
-            if usage:
-                input_tokens = usage.get("input_tokens", 0) + usage.get("cache_read_input_tokens", 0) + usage.get("cache_creation_input_tokens", 0)
-                output_tokens = usage.get("output_tokens", 0)
-                if input_tokens or output_tokens:
-                    stats_parts.append(f"{input_tokens:,} in / {output_tokens:,} out tokens")
-            if stats_parts:
-                send_slack(slack_token, channel, thread_ts, f"_Stats: {' | '.join(stats_parts)}_")
-
-            # Log session completion
-            log_event("info", f"Session completed: {', '.join(summary_parts) if summary_parts else 'no actions'}",
-                      channel=channel, session=session_id,
-                      reads=reads, edits=edits, writes=writes, commands=commands,
-                      globs=globs, greps=greps, web_fetches=web_fetches, web_searches=web_searches,
-                      tasks=tasks, mcp_calls=mcp_calls,
-                      duration_ms=result_stats.get("duration_ms", 0),
-                      cost_usd=result_stats.get("cost", 0))
-        except Exception as e:
-            print(f"Error sending summary/stats: {e}", file=sys.stderr)
-            log_event("error", f"Summary/stats error: {e}", channel=channel, session=session_id)
+                    log_event("error", "Fallback message also failed!", **log_ctx)
+
+        # Send summary if work was done (send_slack never raises, and the result event's
+        # fields are type-checked below, so nothing here can keep us from the reactions)
+        summary_parts = [fmt.format(n=counts[name]) for name, fmt in SUMMARY_SPECS if counts[name]]
+
+        if summary_parts:
+            summary = f"Done: {', '.join(summary_parts)}"
+            if file_actions:
+                # One line per session, however many Edit/Write calls each file took
+                summary += "\nModified: " + ", ".join(
+                    f"`{name}` ({', '.join(label for action, label in FILE_ACTION_LABELS if action in actions)})"
+                    for name, actions in file_actions.items())
+            send_slack(channel, thread_ts, summary)
+
+        # Send stats (duration is always available now via start_time fallback)
+        # Note: cost and tokens may be missing if Claude was interrupted before result event
+        stats_parts = []
+        duration_ms = as_number(result_stats.get("duration_ms"))
+        if duration_ms:
+            duration_sec = duration_ms / 1000
+            stats_parts.append(f"{duration_sec:.1f}s")
+        cost = as_number(result_stats.get("cost"))
+        if cost:
+            stats_parts.append(f"${cost:.4f}")
+        usage = result_stats.get("usage")
+        if isinstance(usage, dict):
+            input_tokens = sum(as_number(usage.get(key)) for key in USAGE_INPUT_TOKEN_KEYS)
+            output_tokens = as_number(usage.get("output_tokens"))
+            if input_tokens or output_tokens:
+                stats_parts.append(f"{input_tokens:,} in / {output_tokens:,} out tokens")
+        if stats_parts:
+            send_slack(channel, thread_ts, f"_Stats: {' | '.join(stats_parts)}_")
+
+        # Log session completion
+        log_event("info", f"Session completed: {', '.join(summary_parts) if summary_parts else 'no actions'}",
+                  **log_ctx, **{name: counts[name] for name, _ in SUMMARY_SPECS},
+                  modified_files=",".join(file_actions) or None, duration_ms=duration_ms, cost_usd=cost)
 
         # Handle final result and reactions
-        # Note: streaming_text already contains the response (streamed in real-time)
+        # Note: the streamed text already contains the response (streamed in real-time)
         # final_result from the result event may have the complete text too
-        has_response = streaming_text or final_result
+        has_response = streaming_len or final_result
 
         if has_response:
-            # If we didn't stream (no streaming_text), send final_result
-            if not streaming_text and final_result:
-                send_slack(slack_token, channel, thread_ts, final_result)
+            # If we didn't stream any text, send final_result
+            if not streaming_len and final_result:
+                send_slack(channel, thread_ts, final_result)
             # Remove processing, add success
-            remove_reaction(slack_token, channel, message_ts, PROCESSING_EMOJI)
-            add_reaction(slack_token, channel, message_ts, SUCCESS_EMOJI)
+            replace_reaction(channel, message_ts, PROCESSING_EMOJI, SUCCESS_EMOJI, after=processing_reaction)
         elif process.returncode != 0:
             # Log the error for debugging
             print(f"Claude exited with code {process.returncode}", file=sys.stderr)
@@ -886,28 +1511,35 @@ User's message: {message}"""
                 error_msg = "\n".join(error_lines[:5])  # First 5 error lines
                 print(f"Error output: {error_msg}", file=sys.stderr)
                 # Send a more helpful error message to Slack
-                send_slack(slack_token, channel, thread_ts, f"Sorry, something went wrong: {error_lines[0][:200]}")
+                send_slack(channel, thread_ts, f"Sorry, something went wrong: {error_lines[0][:200]}")
                 log_event("error", f"Session failed: {error_lines[0][:100]}",
-                          channel=channel, session=session_id, exit_code=process.returncode)
+                          **log_ctx, exit_code=process.returncode)
             else:
-                send_slack(slack_token, channel, thread_ts, "Sorry, something went wrong processing your request.")
+                send_slack(channel, thread_ts, "Sorry, something went wrong processing your request.")
                 log_event("error", "Session failed: unknown error",
-                          channel=channel, session=session_id, exit_code=process.returncode)
+                          **log_ctx, exit_code=process.returncode)
             # Remove processing, add error
-            remove_reaction(slack_token, channel, message_ts, PROCESSING_EMOJI)
-            add_reaction(slack_token, channel, message_ts, ERROR_EMOJI)
+            replace_reaction(channel, message_ts, PROCESSING_EMOJI, ERROR_EMOJI, after=processing_reaction)
         else:
             # No result but no error - just remove processing reaction
-            remove_reaction(slack_token, channel, message_ts, PROCESSING_EMOJI)
-            add_reaction(slack_token, channel, message_ts, SUCCESS_EMOJI)
+            replace_reaction(channel, message_ts, PROCESSING_EMOJI, SUCCESS_EMOJI, after=processing_reaction)
 
     finally:
+        # Never leave Claude (or its tools) running if we bail out early
+        if process is not None:
+            reap_claude(process)
 
-        # Cleanup temp directory
-        try:
-            shutil.rmtree(temp_dir)
-        except Exception as e:
-            print(f"Error cleaning up temp dir: {e}", file=sys.stderr)
+        # Don't drop progress notices on an early exit (no-op after the normal drain)
+        progress.flush()
+
+        # Let pending reactions and updates reach Slack before we exit
+        slack_post_pool.shutdown(wait=True)
+        reaction_pool.shutdown(wait=True)
+
+        # Cleanup temp directory (keep going past individual failures, then report leftovers)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        if os.path.exists(temp_dir):
+            print(f"Error cleaning up temp dir: {temp_dir} could not be fully removed", file=sys.stderr)
 
     print("Done")
 